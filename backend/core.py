@@ -0,0 +1,545 @@
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+
+import httpx
+import numpy as np
+import orjson
+from cachetools import LRUCache, TTLCache
+
+from fastapi import HTTPException
+
+from sql_safety import parse_select
+
+# -------------------------------------------------------
+# CONFIG
+# -------------------------------------------------------
+BASE_DIR = os.path.dirname(__file__)
+DB_PATH = os.path.join(BASE_DIR, "data", "app.db")
+
+OLLAMA_URL = "http://localhost:11434"
+MODEL_NAME = os.getenv("OLLAMA_MODEL", "llama3:8b")
+
+# Requests arriving within MAX_WAIT_MS are sent to Ollama together, and at
+# most MAX_BATCH calls are in flight. Keep it in line with the server's
+# OLLAMA_NUM_PARALLEL.
+MAX_BATCH = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+MAX_WAIT_MS = 10
+
+# Generated SQL per normalized question, and query results for a short TTL.
+# The database is read-only here, so nothing needs invalidating.
+_sql_cache = LRUCache(maxsize=1024)
+_result_cache = TTLCache(maxsize=256, ttl=60)
+_result_lock = threading.Lock()
+_WS_RE = re.compile(r"\s+")
+
+_SELECT_RE = re.compile(r"select", re.I)
+
+# Code fences and invalid columns the model tends to emit
+_FIXUPS = {
+    "```sql": "",
+    "```": "",
+    "orders.total_amount": "orders.amount",
+    "orders.total": "orders.amount",
+    "total_amount": "amount",
+}
+_FIX_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_FIXUPS, key=len, reverse=True))
+)
+
+# Shared async client so Ollama calls don't hold a threadpool worker.
+# Idle connections are kept open so each call skips the TCP handshake.
+client = httpx.AsyncClient(
+    timeout=None,
+    limits=httpx.Limits(
+        max_connections=32,
+        max_keepalive_connections=16,
+        keepalive_expiry=300
+    )
+)
+
+# -------------------------------------------------------
+# RUN SQL
+# -------------------------------------------------------
+_conn = None
+_conn_lock = threading.Lock()
+
+def get_conn():
+    global _conn
+    if _conn is None:
+        if not os.path.exists(DB_PATH):
+            raise HTTPException(status_code=500, detail="Database not found")
+
+        conn = sqlite3.connect(
+            f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False
+        )
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _conn = conn
+    return _conn
+
+def run_sql_fetch(sql: str):
+    with _conn_lock:
+        conn = get_conn()
+
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            columns = [d[0] for d in cur.description]
+            rows = cur.fetchall()
+
+            return {"columns": columns, "rows": rows}
+
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def run_sql_cached(sql: str):
+    with _result_lock:
+        result = _result_cache.get(sql)
+    if result is not None:
+        return result
+
+    result = run_sql_fetch(sql)
+    with _result_lock:
+        _result_cache[sql] = result
+    return result
+
+# -------------------------------------------------------
+# SQL SAFETY
+# -------------------------------------------------------
+def is_safe_sql(sql: str) -> bool:
+    return parse_select(sql, "sqlite") is not None
+
+# -------------------------------------------------------
+# ASK OLLAMA
+# -------------------------------------------------------
+async def _generate(prompt: str) -> str:
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": "30m",
+        "options": {
+            "temperature": 0.0,
+            "num_ctx": 2048,
+            "num_predict": 256,
+        },
+    }
+
+    try:
+        resp = await client.post(
+            f"{OLLAMA_URL}/api/generate",
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+        resp.raise_for_status()
+
+        data = orjson.loads(resp.content)
+        return data.get("response", "").strip()
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model error: {e}")
+
+# -------------------------------------------------------
+# BATCHING
+# -------------------------------------------------------
+_queue = None
+_worker = None
+_inflight = None
+_tasks = set()
+
+async def _run_one(prompt, fut):
+    async with _inflight:
+        try:
+            res = await _generate(prompt)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+
+    if not fut.done():
+        fut.set_result(res)
+
+async def _run_batch(batch):
+    await asyncio.gather(*(_run_one(prompt, fut) for prompt, fut in batch))
+
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await _queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Dispatch without waiting so later requests aren't held behind
+        # the slowest call; the semaphore caps calls in flight.
+        task = asyncio.create_task(_run_batch(batch))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+async def ask_model(prompt: str) -> str:
+    if _queue is None:
+        raise RuntimeError(
+            "Model batching is not running; start the app through its "
+            "lifespan (e.g. `with TestClient(app)`)"
+        )
+
+    fut = asyncio.get_running_loop().create_future()
+    await _queue.put((prompt, fut))
+    return await fut
+
+# -------------------------------------------------------
+# SYSTEM PROMPT
+# -------------------------------------------------------
+SYSTEM_PROMPT = """
+You are an expert SQLite analytics query generator.
+
+RULES:
+1. Output ONLY one valid SQLite SELECT query.
+2. NEVER output explanations or comments.
+3. Use ONLY valid columns from the schema.
+4. NEVER use ":" anywhere in the SQL output.
+5. NEVER generate aliases with ":" (such as month: revenue).
+6. Use ONLY "AS alias" format.
+
+-------------------------------------------------------
+GENERAL TREND ANALYSIS RULES
+-------------------------------------------------------
+If user asks:
+
+- "revenue trend"
+- "revenue trend analysis"
+- "show revenue trend"
+- "trend analysis"
+- "show revenue graph"
+- "monthly revenue"
+- "sales trend"
+- "show analysis of revenue trend"
+
+Then ALWAYS return this SQL pattern:
+
+SELECT 
+    strftime('%Y-%m', orders.order_date) AS month,
+    SUM(orders.amount) AS revenue
+FROM orders
+GROUP BY month
+ORDER BY month;
+
+Never use colon ":" anywhere.
+Never use CASE WHEN.
+Never use JOIN unless summary table needed.
+Never generate explanations — only raw SQL.
+
+
+-------------------------------------------------------
+SCHEMA
+-------------------------------------------------------
+TABLE orders:
+- order_id
+- customer_id
+- product_id
+- order_date
+- amount
+
+TABLE summary:
+- id
+- order_id
+- quantity
+- discount
+- tax
+
+-------------------------------------------------------
+REVENUE DEFINITIONS
+-------------------------------------------------------
+Revenue ALWAYS means: SUM(orders.amount)
+Sales count ALWAYS means: COUNT(orders.order_id)
+
+NEVER generate these invalid columns:
+orders.total, total_amount, revenue_amount, price, total
+
+-------------------------------------------------------
+DATE FILTERS
+-------------------------------------------------------
+This month:
+    orders.order_date >= date('now','start of month')
+
+Last month:
+    orders.order_date >= date('now','start of month','-1 month')
+    AND orders.order_date < date('now','start of month')
+
+Last 6 months:
+    orders.order_date >= date('now','-6 months')
+
+-------------------------------------------------------
+MONTH GROUPING
+-------------------------------------------------------
+strftime('%Y-%m', orders.order_date) AS month
+
+-------------------------------------------------------
+SUMMARY TABLE RULE
+-------------------------------------------------------
+If tax/discount/quantity is used → always join:
+
+FROM summary
+JOIN orders ON summary.order_id = orders.order_id
+
+-------------------------------------------------------
+COMPARISON QUESTIONS (MANDATORY RULE)
+-------------------------------------------------------
+For questions like:
+- "compare last month revenue with this month"
+- "difference between this month and last month"
+- "compare revenue month over month"
+
+Use EXACTLY this SQL pattern:
+
+SELECT 
+    'this_month' AS period,
+    SUM(amount) AS revenue
+FROM orders
+WHERE orders.order_date >= date('now','start of month')
+
+UNION ALL
+
+SELECT
+    'last_month' AS period,
+    SUM(amount) AS revenue
+FROM orders
+WHERE orders.order_date >= date('now','start of month','-1 month')
+  AND orders.order_date < date('now','start of month');
+
+NEVER use CASE WHEN.
+NEVER use concatenation.
+NEVER use subqueries.
+
+-------------------------------------------------------
+UNCERTAIN QUESTIONS
+-------------------------------------------------------
+If unsure:
+SELECT NULL WHERE 0;
+
+Return ONLY RAW SQL.
+-------------------------------------------------------
+TAX ANALYSIS RULES
+-------------------------------------------------------
+If the user asks about:
+- "tax trend"
+- "tax analysis"
+- "show tax trend analysis"
+- "monthly tax"
+- "tax graph"
+- "trend of tax"
+
+Then ALWAYS generate:
+
+SELECT 
+    strftime('%Y-%m', orders.order_date) AS month,
+    SUM(summary.tax) AS tax
+FROM summary
+JOIN orders ON summary.order_id = orders.order_id
+GROUP BY month
+ORDER BY month;
+
+Rules:
+- Output column MUST be named "tax".
+- Do NOT use revenue or amount.
+- Never mix tax with revenue unless explicitly asked.
+
+"""
+
+# Kept byte-identical across requests so Ollama can reuse the cached prefix
+_PROMPT_PREFIX = SYSTEM_PROMPT + "\nUser Question: "
+
+# -------------------------------------------------------
+# CANNED QUERIES
+# -------------------------------------------------------
+# Same SQL the prompt mandates for these intents; answered without the LLM
+SQL_REVENUE_TREND = """SELECT
+    strftime('%Y-%m', orders.order_date) AS month,
+    SUM(orders.amount) AS revenue
+FROM orders
+GROUP BY month
+ORDER BY month"""
+
+SQL_TAX_TREND = """SELECT
+    strftime('%Y-%m', orders.order_date) AS month,
+    SUM(summary.tax) AS tax
+FROM summary
+JOIN orders ON summary.order_id = orders.order_id
+GROUP BY month
+ORDER BY month"""
+
+SQL_COMPARE = """SELECT
+    'this_month' AS period,
+    SUM(amount) AS revenue
+FROM orders
+WHERE orders.order_date >= date('now','start of month')
+
+UNION ALL
+
+SELECT
+    'last_month' AS period,
+    SUM(amount) AS revenue
+FROM orders
+WHERE orders.order_date >= date('now','start of month','-1 month')
+  AND orders.order_date < date('now','start of month')"""
+
+# Only the bare phrases listed in SYSTEM_PROMPT. Anything with extra
+# qualifiers (time window, product, customer, ...) goes to the model so
+# the filter isn't silently dropped.
+_INTENTS = {
+    **dict.fromkeys([
+        "revenue trend",
+        "revenue trend analysis",
+        "show revenue trend",
+        "trend analysis",
+        "show revenue graph",
+        "monthly revenue",
+        "sales trend",
+        "show analysis of revenue trend",
+    ], SQL_REVENUE_TREND),
+    **dict.fromkeys([
+        "tax trend",
+        "tax analysis",
+        "show tax trend analysis",
+        "monthly tax",
+        "tax graph",
+        "trend of tax",
+    ], SQL_TAX_TREND),
+    **dict.fromkeys([
+        "compare last month revenue with this month",
+        "difference between this month and last month",
+        "compare revenue month over month",
+    ], SQL_COMPARE),
+}
+
+def match_intent(question: str):
+    # question is already normalized; ignore trailing punctuation
+    return _INTENTS.get(question.rstrip(" ?.!"))
+
+# -------------------------------------------------------
+# CLEAN SQL
+# -------------------------------------------------------
+def clean_sql(sql: str) -> str:
+    sql = _FIX_RE.sub(lambda m: _FIXUPS[m.group(0)], sql)
+
+    m = _SELECT_RE.search(sql)
+    if m is None:
+        return "SELECT NULL WHERE 0"
+
+    sql = sql[m.start():]
+    sql = sql.split(";")[0]
+
+    return sql.strip()
+
+# -------------------------------------------------------
+# NUMERIC SERIES
+# -------------------------------------------------------
+def extract_series(rows):
+    # First numeric field of each row, in row order, as float64 plus a mask
+    # of which values were ints (only used to print them as the DB did)
+    values = []
+    for r in rows:
+        for v in r:
+            if isinstance(v, (int, float)):
+                values.append(v)
+                break
+
+    series = np.array(values, dtype=np.float64)
+    is_int = np.array([isinstance(v, int) for v in values], dtype=bool)
+    return series, is_int
+
+# -------------------------------------------------------
+# INSIGHT
+# -------------------------------------------------------
+def generate_insight(series):
+    if len(series) < 2:
+        return ""
+
+    prev, last = series[-2], series[-1]
+    if prev == 0:
+        return ""
+
+    change = ((last - prev) / prev) * 100
+
+    if change > 20:
+        return f"Revenue increased sharply (+{change:.2f}%)."
+    if change < -20:
+        return f"Revenue dropped significantly ({change:.2f}%)."
+    return f"Revenue changed by {change:.2f}%."
+
+# -------------------------------------------------------
+# ANOMALY
+# -------------------------------------------------------
+def detect_anomaly(series, is_int):
+    if len(series) < 3:
+        return ""
+
+    avg = series.mean()
+    last = int(series[-1]) if is_int[-1] else series[-1]
+
+    if last > avg * 1.5:
+        return f"⚠️ Anomaly: Latest value {last} is much higher than average {avg:.2f}"
+    if last < avg * 0.5:
+        return f"⚠️ Anomaly: Latest value {last} is much lower than average {avg:.2f}"
+
+    return ""
+
+# -------------------------------------------------------
+# SQL GENERATION
+# -------------------------------------------------------
+def normalize_question(question: str) -> str:
+    return _WS_RE.sub(" ", question.strip().lower())
+
+async def generate_sql(question: str) -> str:
+    key = normalize_question(question)
+
+    sql = match_intent(key)
+    if sql is not None:
+        return sql
+
+    sql = _sql_cache.get(key)
+    if sql is not None:
+        return sql
+
+    prompt = _PROMPT_PREFIX + question + "\nSQL:"
+
+    llm_output = await ask_model(prompt)
+    sql = clean_sql(llm_output)
+
+    print("LLM OUTPUT:", llm_output)
+    print("CLEAN SQL:", sql)
+
+    if not is_safe_sql(sql):
+        sql = "SELECT NULL WHERE 0"
+
+    _sql_cache[key] = sql
+    return sql
+
+# -------------------------------------------------------
+# LIFECYCLE
+# -------------------------------------------------------
+async def start_batching():
+    global _queue, _worker, _inflight
+    _queue = asyncio.Queue()
+    _inflight = asyncio.Semaphore(MAX_BATCH)
+    _worker = asyncio.create_task(_batch_worker())
+
+async def shutdown():
+    _worker.cancel()
+    for task in list(_tasks):
+        task.cancel()
+    await client.aclose()
+    if _conn is not None:
+        _conn.close()
@@ -12,9 +12,17 @@ DATABASE_URL = (
     f"@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
 
+# Recycle connections well before MySQL's wait_timeout (8h by default)
+# instead of pinging on every checkout. Queries are read-only, so
+# autocommit skips per-request transaction bookkeeping.
 engine = create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,
+    pool_size=20,
+    max_overflow=40,
+    pool_recycle=1800,
+    pool_pre_ping=False,
+    isolation_level="AUTOCOMMIT",
+    connect_args={"charset": "utf8mb4"},
     echo=False
 )
 
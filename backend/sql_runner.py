@@ -1,4 +1,7 @@
 from sqlalchemy import text
+from sqlglot import exp
+
+from sql_safety import parse_select
 
 ALLOWED_TABLES = {
     "appointment_trans_summary",
@@ -8,15 +11,11 @@ ALLOWED_TABLES = {
 }
 
 def is_safe_sql(sql: str) -> bool:
-    sql_lower = sql.lower()
-    if not sql_lower.startswith("select"):
+    tree = parse_select(sql, "mysql")
+    if tree is None:
         return False
 
-    for word in ["drop", "delete", "update", "insert", "alter"]:
-        if word in sql_lower:
-            return False
-
-    return any(tbl in sql_lower for tbl in ALLOWED_TABLES)
+    return any(t.name.lower() in ALLOWED_TABLES for t in tree.find_all(exp.Table))
 
 
 def run_sql(db, sql: str):
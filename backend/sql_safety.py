@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+import sqlglot
+from sqlglot import exp
+
+_QUERY_TYPES = (exp.Select, exp.Union, exp.Intersect, exp.Except)
+_WRITE_TYPES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Drop,
+    exp.Alter, exp.Create, exp.Command
+)
+
+@lru_cache(maxsize=1024)
+def parse_select(sql: str, dialect: str):
+    # Parsed tree if sql is a single read-only query, else None
+    try:
+        statements = sqlglot.parse(sql, read=dialect)
+    except sqlglot.errors.SqlglotError:
+        return None
+
+    if len(statements) != 1 or not isinstance(statements[0], _QUERY_TYPES):
+        return None
+
+    tree = statements[0]
+    if any(isinstance(node, _WRITE_TYPES) for node in tree.walk()):
+        return None
+
+    return tree
@@ -102,28 +102,31 @@ export default function App() {
     if (cols.includes("revenue")) return "revenue";
     if (cols.includes("amount")) return "amount";
 
-    for (const c of cols) {
+    for (const [i, c] of cols.entries()) {
       if (c === timeColumn) continue;
-      if (!isNaN(Number(rows[0][c]))) return c;
+      if (!isNaN(Number(rows[0][i]))) return c;
     }
     return null;
   }, [cols, rows, timeColumn]);
 
   // ---------- CHART DATA ----------
+  // rows are arrays aligned with cols
   const chartData = useMemo(() => {
     if (!timeColumn || !numericColumn) return null;
+    const timeIdx = cols.indexOf(timeColumn);
+    const numIdx = cols.indexOf(numericColumn);
     return {
-      labels: rows.map(r => r[timeColumn]),
+      labels: rows.map(r => r[timeIdx]),
       datasets: [
         {
           label: numericColumn,
-          data: rows.map(r => Number(r[numericColumn])),
+          data: rows.map(r => Number(r[numIdx])),
           borderColor: "rgb(75, 192, 192)",
           tension: 0.3,
         },
       ],
     };
-  }, [rows, timeColumn, numericColumn]);
+  }, [cols, rows, timeColumn, numericColumn]);
 
   return (
     <div className="min-h-screen p-6 bg-gray-100">
@@ -220,8 +223,8 @@ export default function App() {
               <tbody>
                 {rows.map((r, i) => (
                   <tr key={i}>
-                    {cols.map(c => (
-                      <td key={c} className="p-2 border-b">{String(r[c])}</td>
+                    {cols.map((c, j) => (
+                      <td key={c} className="p-2 border-b">{String(r[j])}</td>
                     ))}
                   </tr>
                 ))}